@@ -41,24 +41,41 @@
 #     - aws CLI (`brew install awscli`)
 #     - python3 (`brew install python3`)
 #     - ffmpeg (`brew install ffmpeg`)
+# - boto3, the AWS SDK for Python (`pip3 install boto3`)
 # - `awscli` configured (`aws configure`) with correct user
 
 
 
 
 import argparse
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing
 import csv
+import hashlib
 import logging
 import os
 import shutil
 from datetime import datetime
 import subprocess
 import json
+import threading
 import uuid
+from xml.sax.saxutils import escape
+
+import boto3
+from botocore.config import Config
 
 
 
 # COMMAND LINE ARGUMENTS
+# Argument type for counts that must be at least 1 (e.g. a pool of 0 workers would never run, or fail later)
+def positive_int(value):
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError("must be at least 1: %s" % value)
+    return number
+
+
 # Setup Arguments
 parser = argparse.ArgumentParser(description="Text to speech. Takes a file as input, and converts the lines into MP3s.")
 
@@ -74,7 +91,23 @@ parser.add_argument("-f", "--filename",
 parser.add_argument("-o", "--output_dir",
                     default="audioResources/",
                     help="Directory where output files will be saved. \
-                    WARNING: This directory is deleted each time the program is run.")
+                    WARNING: This directory is deleted at the end of the run (unless --verbose), and before the run with --clean.")
+
+parser.add_argument("--clean",
+                    action="store_true",
+                    help="Delete the output directory before the run, instead of reusing the files already in it. \
+                    Only matters with --verbose: otherwise the output directory is deleted at the end of every run anyway.")
+
+parser.add_argument("--lessons_file",
+                    default="es-lessons.json",
+                    help="Name of the JSON file the lessons are written to. \
+                    Give each run its own file (and --output_dir) to run several CSVs at once.")
+
+parser.add_argument("--cache_dir",
+                    default=os.path.join(os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache"), "lingua-freq-tts"),
+                    help="Directory where synthesized MP3s are cached between runs. \
+                    Phrases whose voice, engine, speed, sample rate & text are unchanged are not sent to AWS Polly again \
+                    (so changing --sample_rate synthesizes every phrase again).")
 
 parser.add_argument("--foreign_voice",
                     required=True,
@@ -103,11 +136,26 @@ parser.add_argument("--english_voice_engine",
                     default="standard",
                     help="Allows you to set the voice engine (for ENGLISH VOICE), if supported")
 
+parser.add_argument("--sample_rate",
+                    choices=["8000", "16000", "22050", "24000"],
+                    default="16000",
+                    help="Sample rate (Hz) of the MP3 audio requested from AWS Polly. \
+                    Lower rates give smaller files, at telephone quality for 8000.")
+
 parser.add_argument("--mode",
                     choices=["lessons", "pyramid"],
                     default="lessons",
                     help="Determines which CSV structure and output to use.")
 
+parser.add_argument("-w", "--workers",
+                    type=positive_int,
+                    default=16,
+                    help="Number of phrases to synthesize concurrently (AWS Polly calls run in parallel)")
+
+parser.add_argument("--refresh",
+                    action="store_true",
+                    help="Ignore cached phrase audio and synthesize every phrase with AWS Polly again (the cache is updated)")
+
 # TODO: Add dry run
 
 # Assign arguments to SETTINGS variables
@@ -116,12 +164,18 @@ args = parser.parse_args()
 # SETTINGS VARIABLES
 input_file = args.filename
 output_dir = args.output_dir
+lessons_file = args.lessons_file
+cache_dir = args.cache_dir
 foreign_voice_id = args.foreign_voice
 native_voice_id = args.english_voice # TODO: "native"
 voice_speed = args.speed
 foreign_voice_engine = args.foreign_voice_engine
 native_voice_engine = args.english_voice_engine # TODO: "native"
+sample_rate = args.sample_rate
 mode = args.mode
+workers = args.workers
+refresh = args.refresh
+clean = args.clean
 
 
 # audio/es/"phrase".mp3
@@ -134,122 +188,211 @@ if args.verbose:
 logging.debug('Verbose mode enabled')
 
 
-# Deletes & creates output directory for MP3s
-def create_output_directories():
-    # Remove output from previous runs
-    if os.path.exists(output_dir):
-        shutil.rmtree(output_dir)
-
-    # Create directories for output
-    os.mkdir(output_dir)
+# AWS POLLY CLIENT
+# - One client for the whole run, so the HTTPS connections & credentials are reused across calls
+# - boto3 clients are thread-safe, so it's shared by all worker threads
+# - The connection pool (10 by default) is sized to the worker threads, so requests don't queue for a connection
+# - "adaptive" retries back off & rate-limit the client when Polly throttles concurrent requests
+# - Short timeouts (instead of botocore's 60s) let a stalled connection be retried, rather than holding up a worker
+polly = boto3.client("polly", config=Config(
+    max_pool_connections=workers,
+    connect_timeout=3,
+    read_timeout=30,
+    retries={"max_attempts": 10, "mode": "adaptive"}
+))
 
 
-    print("Output files will be stored at: %s" % output_dir)
+# ffmpeg output is only read for debug logging, so it's discarded (not piped into Python) unless --verbose
+ffmpeg_output = subprocess.PIPE if args.verbose else subprocess.DEVNULL
 
 
-# Calls AWS Polly API and creates PCM audio files
-def create_pcm_from_ssml(voice_id, engine, ssml_text, filename):
-    logging.debug("\n\n-------[ AWS Polly to PCM ]--------")
-    logging.debug("Voice ID: " + voice_id)
-    logging.debug("SSML: " + ssml_text)
-    logging.debug("Filename: \"" + filename + "\"")
+# Runs an `ffmpeg` command
+# - Only the silent clips are encoded with ffmpeg (at most one per length, and none once cached), so it isn't rate-limited
+# - Raises CalledProcessError if ffmpeg fails, instead of carrying on without its output file
+def run_ffmpeg(cmd, input=None):
+    return subprocess.run(cmd, input=input, stdout=ffmpeg_output, stderr=ffmpeg_output, check=True)
 
-    # Build out command to call AWS Polly to generate speech files
-    cmd = [
-        "aws", "polly", "synthesize-speech",
-        "--output-format", "pcm",
-        "--sample-rate", "16000",
-        "--text-type", "ssml",
-        "--voice-id", voice_id,
-        "--engine", engine,
-        "--text", ssml_text,
-        filename
-    ]
 
-    logging.debug("Polly CMD: \n" + subprocess.list2cmdline(cmd))
-    process = subprocess.run(cmd, capture_output=True, text=True)
-    logging.debug("Polly CMD standard output: \n" + process.stdout)
-    logging.debug("Polly CMD error output: \n" + process.stderr)
+# Creates output directory for MP3s
+# - Output files are named after their content, so a re-run updates the same files instead of adding new ones
+# - Files are only left over from a previous run if it used --verbose (otherwise main() deletes the output directory)
+# - With --clean, previous output is renamed out of the way, then deleted in the background while new audio is created
+def create_output_directories():
+    if clean:
+        remove_output_directory()
 
+    # Create directories for output (including missing parent directories)
+    os.makedirs(output_dir, exist_ok=True)
 
-# Converts a PCM audio file to WAV audio file
-def convert_pcm_to_wav(input_filename):
-    logging.debug("\n\n--------[ Converting PCM to WAV ]--------")
-    logging.debug("Input filename: " + input_filename)
+    # Cache is kept between runs
+    os.makedirs(cache_dir, exist_ok=True)
 
-    output_filename = input_filename.replace(".pcm", ".wav")
-    logging.debug("Output filename: " + output_filename)
 
-    # Build out `ffmpeg` command to convert PCM to WAV
-    cmd = [
-        "ffmpeg",
-        "-y",
-        "-f", "s16le",
-        "-ar", "16000",
-        "-ac", "1",
-        "-i", input_filename,
-        output_filename
-    ]
+    print("Output files will be stored at: %s" % output_dir)
 
-    logging.debug("FFMPEG PCM to WAV CMD: \n" + subprocess.list2cmdline(cmd))
-    process = subprocess.run(cmd, capture_output=True, text=True)
-    logging.debug("FFMPEG PCM to WAV standard output: \n" + process.stdout)
-    logging.debug("FFMPEG PCM to WAV error output: \n" + process.stderr)
 
-    os.remove(input_filename)
+# Removes output from previous runs
+def remove_output_directory():
+    old_output_dir = "{output_dir}.old.{pid}".format(output_dir=os.path.normpath(output_dir), pid=os.getpid())
+    try:
+        os.rename(output_dir, old_output_dir)
+    except FileNotFoundError:
+        pass
+    except OSError:
+        shutil.rmtree(output_dir, ignore_errors=True)
+    else:
+        threading.Thread(target=shutil.rmtree, args=(old_output_dir,), kwargs={"ignore_errors": True}).start()
+
+
+# Size of the chunks AWS Polly audio is streamed to disk in
+MP3_CHUNK_SIZE = 64 * 1024
+
+
+# Calls AWS Polly API and saves the MP3 audio it returns
+# - Polly encodes the MP3 itself, so phrases never go through ffmpeg
+def create_mp3_from_ssml(voice_id, engine, ssml_text, output_filename):
+    logging.debug("\n\n-------[ AWS Polly to MP3 ]--------")
+    logging.debug("Voice ID: %s", voice_id)
+    logging.debug("SSML: %s", ssml_text)
+
+    # Call AWS Polly to generate speech, and save the audio stream
+    response = polly.synthesize_speech(
+        OutputFormat="mp3",
+        SampleRate=sample_rate,
+        TextType="ssml",
+        VoiceId=voice_id,
+        Engine=engine,
+        Text=ssml_text
+    )
+
+    # Stream the audio to disk in chunks, instead of reading it all into memory first
+    # - The stream is always closed, so its connection goes back to the pool even if writing fails
+    with closing(response["AudioStream"]) as audio_stream, open(output_filename, "wb") as mp3_file:
+        shutil.copyfileobj(audio_stream, mp3_file, MP3_CHUNK_SIZE)
+        mp3_size = mp3_file.tell()
+
+    logging.debug("Polly request ID: %s", response["ResponseMetadata"]["RequestId"])
+    logging.debug("MP3 audio size: %d bytes", mp3_size)
 
     return output_filename
 
 
-# Converts a WAV audio file to an MP3 audio file
-def convert_wav_to_mp3(input_filename):
-    logging.debug("\n\n--------[ Convert WAV to MP3  ]--------")
-    logging.debug("Input filename: " + input_filename)
-    output_filename = input_filename.replace(".wav", ".mp3")
-    logging.debug("Output filename: " + output_filename)
+# MP3 encoding for files created with ffmpeg (silence)
+# - Constant 64 kbit/s mono is plenty for speech, and much smaller than ffmpeg's default (128 kbit/s)
+MP3_BITRATE = "64k"
 
-    # Build out `ffmpeg` command to convert a WAV file to and MP3
+
+# Converts PCM audio (in memory) to an MP3 audio file
+# - Used for silence clips: the zeroed PCM is encoded straight to MP3, without an intermediate WAV file
+def convert_pcm_to_mp3(pcm_audio, output_filename):
+    logging.debug("\n\n--------[ Converting PCM to MP3 ]--------")
+    logging.debug("Output filename: %s", output_filename)
+
+    # Build out `ffmpeg` command to convert PCM (read from stdin) to MP3
     cmd = [
         "ffmpeg",
         "-y",
-        "-i", input_filename,
+        "-f", "s16le",
+        "-ar", sample_rate,
+        "-ac", "1",
+        "-i", "pipe:0",
+        "-codec:a", "libmp3lame",
+        "-b:a", MP3_BITRATE,
+        "-f", "mp3",
         output_filename
     ]
 
-    logging.debug("FFMPEG Convert WAV to MP3 CMD: \n" + subprocess.list2cmdline(cmd))
-    process = subprocess.run(cmd, capture_output=True, text=True)
-    logging.debug("FFMPEG Convert WAV to MP3 standard output: \n" + process.stdout)
-    logging.debug("FFMPEG Convert WAV to MP3 error output: \n" + process.stderr)
-
-    os.remove(input_filename)
+    if args.verbose:
+        logging.debug("FFMPEG PCM to MP3 CMD: \n%s", subprocess.list2cmdline(cmd))
+    process = run_ffmpeg(cmd, input=pcm_audio)
+    if args.verbose:
+        logging.debug("FFMPEG PCM to MP3 standard output: \n%s", process.stdout.decode(errors="replace"))
+        logging.debug("FFMPEG PCM to MP3 error output: \n%s", process.stderr.decode(errors="replace"))
 
     return output_filename
 
 
-# Creates a WAV audio file from text
-# - Calls AWS Polly, gets a PCM file, convert that file to WAV
-def text_to_wav(voice_id, voice_engine, text, voice_speed=voice_speed):
-    logging.debug("\n\n-------[ Text to WAV: {text} ]--------".format(text=text))
-    logging.debug("Voice ID: " + voice_id)
-    logging.debug("Voice Engine: " + voice_engine)
-    logging.debug("Text: " + text)
-    logging.debug("Speed: " + str(voice_speed))
-
-    ssml_text = "<speak><prosody rate='{voice_speed}%'>{text}</prosody></speak>".format(
-        voice_speed=voice_speed, text=text)
-    pcm_filename = output_dir + voice_id + " - " + text + " - " + str(voice_speed) + ".pcm"
-
-    pcm_filename = output_dir + voice_id + "_" + str(uuid.uuid4()) + "_" + str(voice_speed) + ".pcm"
-
-    create_pcm_from_ssml(voice_id, voice_engine, ssml_text, pcm_filename)
-    wav_filename = convert_pcm_to_wav(pcm_filename)
-
-    logging.debug("Text to WAV - Output filename: " + wav_filename)
-    logging.debug("---[ END: Text to WAV: {text} ]---".format(text=text))
-    return wav_filename
-
-
-
+# SSML sent to AWS Polly for every phrase
+# - Every phrase is spoken at --speed, so the rate is filled in once here, and only {text} is left per phrase
+# - Text must be XML-escaped before it's inserted (e.g. "&" or "<" in a phrase makes the SSML invalid)
+SSML_TEMPLATE = "<speak><prosody rate='{voice_speed}%'>{{text}}</prosody></speak>".format(voice_speed=voice_speed)
+
+
+# Creates an MP3 audio file from text
+# - Calls AWS Polly, which returns the MP3 audio directly
+# - Safe to run in a worker thread: files are named after the cache key, and each key is only created once per run
+# - File names are the same on every run, so es-lessons.json only changes when the phrases do
+# - MP3s are cached by (voice, engine, speed, sample rate, text), so unchanged phrases skip AWS Polly on later runs
+# - With --refresh, every phrase is synthesized again and replaces its cached MP3
+def text_to_mp3(voice_id, voice_engine, text):
+    logging.debug("\n\n-------[ Text to MP3: %s ]--------", text)
+    logging.debug("Voice ID: %s", voice_id)
+    logging.debug("Voice Engine: %s", voice_engine)
+    logging.debug("Text: %s", text)
+    logging.debug("Speed: %s", voice_speed)
+
+    cache_key = hashlib.sha256("{voice_id}|{voice_engine}|{voice_speed}|{sample_rate}|polly-mp3|{text}".format(
+        voice_id=voice_id, voice_engine=voice_engine, voice_speed=voice_speed, sample_rate=sample_rate,
+        text=text).encode("utf-8")).hexdigest()
+    cached_filename = os.path.join(cache_dir, cache_key + ".mp3")
+    mp3_filename = os.path.join(output_dir, voice_id + "_" + cache_key + "_" + str(voice_speed) + ".mp3")
+
+    if not refresh and os.path.exists(cached_filename):
+        logging.debug("Cache hit: %s", cached_filename)
+        link_or_copy_file(cached_filename, mp3_filename)
+    else:
+        # Polly's audio is saved under a temporary name, then renamed onto the output file
+        # - The output file may be a link to a cached MP3 (from an earlier run), which must not be overwritten in place
+        # - A failed download never leaves a partial MP3 behind, in the output or in the cache
+        ssml_text = SSML_TEMPLATE.format(text=escape(text))
+        temp_filename = temporary_filename(mp3_filename)
+        try:
+            create_mp3_from_ssml(voice_id, voice_engine, ssml_text, temp_filename)
+            os.replace(temp_filename, mp3_filename)
+        finally:
+            if os.path.exists(temp_filename):
+                os.remove(temp_filename)
+        link_or_copy_file(mp3_filename, cached_filename)
+
+    logging.debug("Text to MP3 - Output filename: %s", mp3_filename)
+    logging.debug("---[ END: Text to MP3: %s ]---", text)
+    return mp3_filename
+
+
+# Returns a unique temporary name next to a file, so it's on the same filesystem (and can be renamed onto it)
+def temporary_filename(target_filename):
+    return "{target_filename}.{id}.tmp".format(target_filename=target_filename, id=uuid.uuid4().hex)
+
+
+# Hard-links a file (no data is copied), or copies it when linking isn't possible (e.g. across filesystems)
+# - The link or copy is made under a temporary name, then renamed onto the target in one step
+# - Other runs (and worker threads) see either the old target or the complete new one, never a partial copy
+# - The target is replaced, not written to, so other files linked to it (e.g. in the cache) are never modified
+def link_or_copy_file(source_filename, target_filename):
+    temp_filename = temporary_filename(target_filename)
+    try:
+        try:
+            os.link(source_filename, temp_filename)
+        except OSError:
+            shutil.copyfile(source_filename, temp_filename)
+        os.replace(temp_filename, target_filename)
+    finally:
+        # Still there if copying failed, or if the target was already a link to the same file (rename does nothing)
+        if os.path.exists(temp_filename):
+            os.remove(temp_filename)
+
+
+
+
+
+# Audio files created for each lesson row
+# - (name, CSV column, voice ID, voice engine); every file is spoken at --speed
+LESSON_AUDIO_FILES = [
+    ("foreign_phrase", 1, foreign_voice_id, foreign_voice_engine),         # FW (Foreign Word)
+    ("native_phrase", 2, native_voice_id, native_voice_engine),            # EW (English Word)
+    ("foreign_sentence", 3, foreign_voice_id, foreign_voice_engine),       # FP (Foreign Phrase)
+    ("native_sentence", 4, native_voice_id, native_voice_engine),          # EP (English Phrase)
+]
 
 
 # CSV to Text-to-speech (TTS)
@@ -257,10 +400,6 @@ def text_to_wav(voice_id, voice_engine, text, voice_speed=voice_speed):
 # - Reads a CSV file which contains the words & phrases
 # - For each set of words & phrases, create WAV lessons based on templates
 def lessons_from_csv(input_file):
-    short_silence_file = convert_wav_to_mp3(create_silent_wav_file(1.0))
-    medium_silence_file = convert_wav_to_mp3(create_silent_wav_file(1.5))
-    long_silence_file = convert_wav_to_mp3(create_silent_wav_file(4))
-
     # JSON
     #    lessons []
 
@@ -269,107 +408,152 @@ def lessons_from_csv(input_file):
 
 
 
-    # Open CSV file which has columns: FW | EW | FP | EP
-    with open(input_file) as cvs_file:
-        csv_reader = csv.reader(cvs_file, delimiter=',')
-        for row in csv_reader:
+    # Submit phrases as the CSV is read, so many AWS Polly requests are in flight at once
+    # - Each row keeps its futures, and lessons are assembled in CSV order below
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        # If anything fails, queued Polly requests are cancelled, instead of all being sent before the error is raised
+        try:
+            # Silent clips are made by ffmpeg in the same pool, so they overlap with the Polly requests
+            # - They have fixed names (silence_<seconds>s.mp3) next to the phrase MP3s, and aren't listed in the JSON
+            silence_futures = [executor.submit(create_silent_mp3_file, seconds) for seconds in SILENCE_LENGTHS]
 
-            # Assign words & phrases from CSV format
-            frequency_rank = row[0]
-            foreign_phrase_text = row[1]
-            native_phrase_text = row[2]
-            foreign_sentence_text = row[3]
-            native_sentence_text = row[4]
+            # Identical phrases (same voice, engine & text) are synthesized once, and share one MP3
+            phrase_futures = {}
 
-            print("#######")
-            print("Frequency rank: " + frequency_rank)
-            print("#######")
+            def submit_phrase(voice_id, voice_engine, text):
+                phrase_key = (voice_id, voice_engine, text)
+                if phrase_key not in phrase_futures:
+                    phrase_futures[phrase_key] = executor.submit(text_to_mp3, voice_id, voice_engine, text)
+                return phrase_futures[phrase_key]
 
+            pending_rows = []
 
+            # Open CSV file which has columns: FW | EW | FP | EP
+            # - Rows are streamed: the first Polly requests start while the rest of the file is read
+            # - Read as UTF-8 whatever the platform encoding, skipping a BOM (e.g. from Excel) so it isn't part of row 1
+            with open(input_file, encoding="utf-8-sig", newline="") as cvs_file:
+                csv_reader = csv.reader(cvs_file, delimiter=',')
+                for row in csv_reader:
 
-            # Create WAV files for each word & phrases
-            # -----------------------------------------
+                    # Skip blank & malformed rows, before any AWS Polly request is paid for them
+                    row = [cell.strip() for cell in row]
+                    if not any(row):
+                        continue
+                    if len(row) < 5 or not all(row[:5]) or not row[0].isdecimal():
+                        print("Skipping malformed row (expected: rank,FW,EW,FP,EP): " + ",".join(row))
+                        continue
 
-            # Create WAV for FW (Foreign Word)
-            foreign_phrase_file = convert_wav_to_mp3(text_to_wav(foreign_voice_id, foreign_voice_engine, foreign_phrase_text))
+                    # Assign words & phrases from CSV format
+                    frequency_rank = row[0]
+                    foreign_phrase_text = row[1]
+                    native_phrase_text = row[2]
+                    foreign_sentence_text = row[3]
+                    native_sentence_text = row[4]
 
-            # Create WAV for EW (English Word)
-            native_phrase_file = convert_wav_to_mp3(text_to_wav(native_voice_id, native_voice_engine, native_phrase_text))
+                    logging.info("Frequency rank: %s", frequency_rank)
 
-            # Create WAV for FP (Foreign Phrase)
-            foreign_sentence_file = convert_wav_to_mp3(text_to_wav(foreign_voice_id, foreign_voice_engine, foreign_sentence_text))
 
-            # Create WAV for FP (Foreign Phrase)
-            foreign_sentence_slow_file = convert_wav_to_mp3(text_to_wav(foreign_voice_id, foreign_voice_engine, foreign_sentence_text, voice_speed=80))
 
-            # Create WAV for EP (English Phrase)
-            native_sentence_file = convert_wav_to_mp3(text_to_wav(native_voice_id, native_voice_engine, native_sentence_text))
+                    # Create MP3 files for each word & phrases
+                    # -----------------------------------------
+                    audio_futures = {
+                        name: submit_phrase(voice_id, voice_engine, row[column])
+                        for name, column, voice_id, voice_engine in LESSON_AUDIO_FILES
+                    }
 
+                    pending_rows.append((row, audio_futures))
+
+            for row, audio_futures in pending_rows:
+                frequency_rank, foreign_phrase_text, native_phrase_text, foreign_sentence_text, native_sentence_text = row[:5]
+
+                # Wait for the audio files of this row
+                audio_files = {name: audio_future.result() for name, audio_future in audio_futures.items()}
+
+
+
+                # # TODO: Update to cleaner jSON format
+                # foreign_phrase = {"text": foreign_phrase_text, "audioResource": ""}
+                # native_phrase = {"text": native_phrase_text, "audioResource": ""}
+                # phrase = {"foreign": foreign_phrase, "native": native_phrase}
+                # foreign_sentence = {"text": foreign_sentence_text, "audioResource": ""}
+                # native_sentence = {"text": native_sentence_text, "audioResource": ""}
+                # sentence = {"foreign": foreign_sentence, "native": native_sentence}
+                # lesson = {"phrase": phrase, "sentence": sentence, "frequencyRank": int(frequency_rank)}
+                #
+
+                lesson = {
+                    "frequencyRank": int(frequency_rank),
+                    "phrase": {
+                        "foreign": {
+                            "text": foreign_phrase_text,
+                            "audioResource": audio_files["foreign_phrase"]
+                        },
+                        "native": {
+                            "text": native_phrase_text,
+                            "audioResource": audio_files["native_phrase"]
+                        }
+                    },
+                    "sentence": {
+                        "foreign": {
+                            "text": foreign_sentence_text,
+                            "audioResource": audio_files["foreign_sentence"]
+                        },
+                        "native": {
+                            "text": native_sentence_text,
+                            "audioResource": audio_files["native_sentence"]
+                        }
+                    },
+                }
 
+                lessons.append(lesson)
 
-            # # TODO: Update to cleaner jSON format
-            # foreign_phrase = {"text": foreign_phrase_text, "audioResource": ""}
-            # native_phrase = {"text": native_phrase_text, "audioResource": ""}
-            # phrase = {"foreign": foreign_phrase, "native": native_phrase}
-            # foreign_sentence = {"text": foreign_sentence_text, "audioResource": ""}
-            # native_sentence = {"text": native_sentence_text, "audioResource": ""}
-            # sentence = {"foreign": foreign_sentence, "native": native_sentence}
-            # lesson = {"phrase": phrase, "sentence": sentence, "frequencyRank": int(frequency_rank)}
-            #
+            # Wait for the silent clips, so an ffmpeg failure is raised here
+            for silence_future in silence_futures:
+                silence_future.result()
+        except BaseException:
+            executor.shutdown(cancel_futures=True)
+            raise
 
-            lesson = {
-                "frequencyRank": int(frequency_rank),
-                "phrase": {
-                    "foreign": {
-                        "text": foreign_phrase_text,
-                        "audioResource": foreign_phrase_file
-                    },
-                    "native": {
-                        "text": native_phrase_text,
-                        "audioResource": native_phrase_file
-                    }
-                },
-                "sentence": {
-                    "foreign": {
-                        "text": foreign_sentence_text,
-                        "audioResource": foreign_sentence_file
-                    },
-                    "native": {
-                        "text": native_sentence_text,
-                        "audioResource": native_sentence_file
-                    }
-                },
-            }
 
-            lessons.append(lesson)
 
 
+    # Written as UTF-8 explicitly: ensure_ascii=False keeps foreign text as-is, which the platform encoding may not support
+    with open(lessons_file, "w", encoding="utf-8") as json_export:
+        json_export.write(json.dumps(lessons, indent=2, ensure_ascii=False))
 
+    print("Lessons written to: %s (%d lessons)" % (lessons_file, len(lessons)))
 
-    json_export = open("es-lessons.json", "w")
-    json_export.write(json.dumps(lessons, indent=2, ensure_ascii=False))
-    json_export.close()
+# Lengths (in seconds) of the silent clips created alongside the phrases
+SILENCE_LENGTHS = [1.0, 1.5, 4]
 
-# Creates silent WAV files of a given length in seconds
-def create_silent_wav_file(seconds):
-    logging.debug("\n\n--------[ Creating silent audio file: {seconds} seconds ]--------".format(seconds=seconds))
 
-    filename = output_dir + "silence_{seconds}s.wav".format(seconds=seconds)
-    logging.debug(filename)
+# Creates silent MP3 files of a given length in seconds
+# - Silence is just zeroed 16-bit PCM, so it's built in memory & encoded with ffmpeg
+# - Silence never changes for a given length & sample rate, so it's cached like phrases are
+def create_silent_mp3_file(seconds):
+    logging.debug("\n\n--------[ Creating silent audio file: %s seconds ]--------", seconds)
 
-    cmd = [
-        "ffmpeg",
-        "-y",
-        "-f", "lavfi",
-        "-i", "anullsrc=channel_layout=mono:sample_rate=16000",
-        "-t", "{seconds}".format(seconds=seconds),
-        filename
-    ]
+    filename = os.path.join(output_dir, "silence_{seconds}s.mp3".format(seconds=seconds))
+    logging.debug(filename)
 
-    logging.debug("FFMPEG Create Silent Audio CMD: \n" + subprocess.list2cmdline(cmd))
-    process = subprocess.run(cmd, capture_output=True, text=True)
-    logging.debug("FFMPEG Create Silent Audio standard output: \n" + process.stdout)
-    logging.debug("FFMPEG Create Silent Audio error output: \n" + process.stderr)
+    cached_filename = os.path.join(cache_dir, "silence_{seconds}s_{sample_rate}_{mp3_bitrate}.mp3".format(
+        seconds=seconds, sample_rate=sample_rate, mp3_bitrate=MP3_BITRATE))
+
+    if os.path.exists(cached_filename):
+        logging.debug("Cache hit: %s", cached_filename)
+        link_or_copy_file(cached_filename, filename)
+        return filename
+
+    # Encoded under a temporary name, then renamed onto the output file (which may be a link to a cached MP3)
+    silent_pcm_audio = bytes(int(seconds * int(sample_rate)) * 2)
+    temp_filename = temporary_filename(filename)
+    try:
+        convert_pcm_to_mp3(silent_pcm_audio, temp_filename)
+        os.replace(temp_filename, filename)
+    finally:
+        if os.path.exists(temp_filename):
+            os.remove(temp_filename)
+    link_or_copy_file(filename, cached_filename)
 
     return filename
 
@@ -389,9 +573,11 @@ def main():
 
 
     # Create text-to-speech phrase files from CSV file
-    if "lessons" in mode:
+    if mode == "lessons":
         logging.debug("Using Mode: lesson")
         lessons_from_csv(input_file)
+    else:
+        print("Mode is not implemented yet: %s (no audio files were created)" % mode)
 
 
     # Delete workspace directories unless verbose/debug mode is enabled